@@ -16,10 +16,14 @@ setup(name='target-stitch',
           'singer-python==6.0.0',
           'psutil==5.6.6',
           'simplejson==3.11.1',
+          'orjson==3.10.12',
           'aiohttp==3.11.9',
 	  'ciso8601',
       ],
       extras_require={
+          'msgpack': [
+              'msgpack==1.1.0'
+          ],
           'dev': [
               'nose==1.3.7',
               'astroid==2.1.0',
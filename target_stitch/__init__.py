@@ -6,22 +6,18 @@ Target for Stitch API.
 '''
 
 import argparse
-import copy
 import gzip
-import http.client
 import io
 import json
+import logging
 import os
-import re
 import sys
 import time
-import urllib
 import functools
 
-from threading import Thread
+from threading import Condition, Thread
 from contextlib import contextmanager
 from collections import namedtuple
-from datetime import datetime, timezone
 from decimal import Decimal, getcontext
 import asyncio
 import concurrent
@@ -30,26 +26,37 @@ import simplejson
 import psutil
 
 import aiohttp
-from aiohttp.client_exceptions import ClientConnectorError, ClientResponseError
+from aiohttp.client_exceptions import ClientConnectorError, ClientOSError, ServerDisconnectedError
 
-from jsonschema import ValidationError, Draft4Validator, FormatChecker
-import pkg_resources
+from jsonschema import Draft4Validator, FormatChecker
 import backoff
 
 import singer
 from singer import metrics
 import ciso8601
 
+from target_stitch.exceptions import TargetStitchException, BatchTooLargeException
+from target_stitch.encoding import (
+    BIGBATCH_MAX_BATCH_BYTES,
+    HAS_MSGPACK,
+    dumps,
+    generate_sequence,
+    pack,
+    read_packed_bodies,
+    serialize,
+    serialize_batches,
+)
+
 LOGGER = singer.get_logger().getChild('target_stitch')
 
 # We use this to store schema and key properties from SCHEMA messages
 StreamMeta = namedtuple('StreamMeta', ['schema', 'key_properties', 'bookmark_properties'])
 
-BIGBATCH_MAX_BATCH_BYTES = 20000000
 DEFAULT_MAX_BATCH_BYTES = 4000000
 DEFAULT_MAX_BATCH_RECORDS = 20000
-MILLISECOND_SEQUENCE_MULTIPLIER = 1000
-NANOSECOND_SEQUENCE_MULTIPLIER = 1000000
+KEEPALIVE_TIMEOUT_SECONDS = 45
+MIN_COMPRESS_BYTES = 16384
+STDIN_BUFFER_BYTES = 262144
 
 # This is our singleton aiohttp session
 OUR_SESSION = None
@@ -64,13 +71,23 @@ PENDING_REQUESTS = []
 # The event loop thread will write to it after each aiohttp request completes
 SEND_EXCEPTION = None
 
+# The event loop thread notifies this condition after every request completes
+# so the main thread can wait on it instead of polling PENDING_REQUESTS.
+REQUESTS_CHANGED = Condition()
+
 CONFIG = {}
 
 def start_loop(loop):
     asyncio.set_event_loop(loop)
     global OUR_SESSION
     timeout = aiohttp.ClientTimeout(sock_connect=60, sock_read=60)
-    OUR_SESSION = aiohttp.ClientSession(connector=aiohttp.TCPConnector(loop=loop), timeout=timeout)
+    # Batches can be further apart than aiohttp's default 15 second keep-alive,
+    # so hold idle connections longer to avoid a new TLS handshake per batch.
+    # This has to stay below the idle timeout of the load balancers in front
+    # of Stitch (commonly 60 seconds), otherwise we may reuse a connection
+    # the server has already closed.
+    connector = aiohttp.TCPConnector(loop=loop, keepalive_timeout=KEEPALIVE_TIMEOUT_SECONDS)
+    OUR_SESSION = aiohttp.ClientSession(connector=connector, timeout=timeout)
     loop.run_forever()
 
 new_loop = asyncio.new_event_loop()
@@ -83,28 +100,22 @@ t.daemon = True
 t.start()
 
 
-class TargetStitchException(Exception):
-    '''A known exception for which we don't need to print a stack trace'''
-
 class StitchClientResponseError(Exception):
     def __init__(self, status, response_body):
         self.response_body = response_body
         self.status = status
         super().__init__()
 
-class MemoryReporter(Thread):
-    '''Logs memory usage every 30 seconds'''
+PROCESS = psutil.Process()
 
-    def __init__(self):
-        self.process = psutil.Process()
-        super().__init__(name='memory_reporter', daemon=True)
-
-    def run(self):
-        while True:
-            LOGGER.debug('Virtual memory usage: %.2f%% of total: %s',
-                         self.process.memory_percent(),
-                         self.process.memory_info())
-            time.sleep(30.0)
+def log_memory_usage():
+    '''We call this with every flush to print out the current memory usage'''
+    # Only sample when it will be logged, since it reads from /proc
+    if not LOGGER.isEnabledFor(logging.DEBUG):
+        return
+    LOGGER.debug('Virtual memory usage: %.2f%% of total: %s',
+                 PROCESS.memory_percent(),
+                 PROCESS.memory_info())
 
 
 class Timings:
@@ -140,10 +151,6 @@ class Timings:
 TIMINGS = Timings()
 
 
-class BatchTooLargeException(TargetStitchException):
-    '''Exception for when the records and schema are so large that we can't
-    create a batch with even one record.'''
-
 def _log_backoff(details):
     (_, exc, _) = sys.exc_info()
     LOGGER.info(
@@ -209,6 +216,10 @@ class StitchHandler: # pylint: disable=too-few-public-methods
         self.token = CONFIG.get('token')
         self.max_batch_bytes = max_batch_bytes
         self.max_batch_records = max_batch_records
+        self.request_headers = {
+            'Authorization': f'Bearer {self.token}',
+            'Content-Type': 'application/json'
+        }
 
     @staticmethod
     #this happens in the event loop
@@ -217,44 +228,50 @@ class StitchHandler: # pylint: disable=too-few-public-methods
         global PENDING_REQUESTS
         global SEND_EXCEPTION
 
-        completed_count = 0
-
-        #NB> if/when the first coroutine errors out, we will record it for examination by the main threa.
-        #if/when this happens, no further flushing of state should ever occur.  the main thread, in fact,
-        #should shutdown quickly after it spots the exception
-        if SEND_EXCEPTION is None:
-            SEND_EXCEPTION = future.exception()
-
-        if SEND_EXCEPTION is not None:
-            LOGGER.info('FLUSH early exit because of SEND_EXCEPTION: %s', pformat(SEND_EXCEPTION))
-            return
-
         try:
-            for f, s in PENDING_REQUESTS:
-                if f.done():
-                    completed_count = completed_count + 1
-                    #NB> this is a very import line.
-                    #NEVER blinding emit state just because a coroutine has completed.
-                    #if this were None, we would have just nuked the client's state
-                    if s:
-                        line = simplejson.dumps(s)
-                        state_writer.write(f"{line}\n")
-                        state_writer.flush()
-                else:
-                    break
+            completed_count = 0
+
+            #NB> if/when the first coroutine errors out, we will record it for examination by the main threa.
+            #if/when this happens, no further flushing of state should ever occur.  the main thread, in fact,
+            #should shutdown quickly after it spots the exception
+            if SEND_EXCEPTION is None:
+                SEND_EXCEPTION = future.exception()
 
-            PENDING_REQUESTS = PENDING_REQUESTS[completed_count:]
+            if SEND_EXCEPTION is not None:
+                LOGGER.info('FLUSH early exit because of SEND_EXCEPTION: %s', pformat(SEND_EXCEPTION))
+                return
 
-        except BaseException as err:
-            SEND_EXCEPTION = err
+            try:
+                lines = []
+                for f, s in PENDING_REQUESTS:
+                    if f.done():
+                        completed_count = completed_count + 1
+                        #NB> this is a very import line.
+                        #NEVER blinding emit state just because a coroutine has completed.
+                        #if this were None, we would have just nuked the client's state
+                        if s:
+                            lines.append(dumps(s).decode('utf-8'))
+                    else:
+                        break
+
+                # Emit every completed state with a single write and flush
+                if lines:
+                    state_writer.write('\n'.join(lines) + '\n')
+                    state_writer.flush()
+
+                PENDING_REQUESTS = PENDING_REQUESTS[completed_count:]
+
+            except BaseException as err:
+                SEND_EXCEPTION = err
+        finally:
+            #wake up the main thread if it is waiting on PENDING_REQUESTS in finish_requests
+            with REQUESTS_CHANGED:
+                REQUESTS_CHANGED.notify_all()
 
 
     def headers(self):
         '''Return the headers based on the token'''
-        return {
-            'Authorization': f'Bearer {self.token}',
-            'Content-Type': 'application/json'
-        }
+        return self.request_headers
 
     def send(self, data, contains_activate_version, state_writer, state, stitch_url):
         '''Send the given data to Stitch, retrying on exceptions'''
@@ -270,6 +287,13 @@ class StitchHandler: # pylint: disable=too-few-public-methods
 
         LOGGER.info("Sending batch of %d bytes to %s", len(data), stitch_url)
 
+        # Level 1 is nearly as fast as a copy and still shrinks typical
+        # JSON batches several times over
+        if CONFIG.get('compress_requests') and len(data) > MIN_COMPRESS_BYTES:
+            data = gzip.compress(data, compresslevel=1)
+            headers = {**headers, 'Content-Encoding': 'gzip'}
+            LOGGER.debug("Compressed batch to %d bytes", len(data))
+
         #NB> before we send any activate_versions we must ensure that all PENDING_REQUETS complete.
         #this is to ensure ordering in the case of Full Table replication where the Activate Version,
         #must arrive AFTER all of the relevant data.
@@ -345,15 +369,16 @@ class StitchHandler: # pylint: disable=too-few-public-methods
 
 class LoggingHandler:  # pylint: disable=too-few-public-methods
     '''Logs records to a local output file.'''
-    def __init__(self, output_file, max_batch_bytes, max_batch_records):
+    def __init__(self, output_file, max_batch_bytes, max_batch_records, output_format='json'):
         self.output_file = output_file
         self.max_batch_bytes = max_batch_bytes
         self.max_batch_records = max_batch_records
+        self.output_format = output_format
 
     def handle_state_only(self, state_writer=None, state=None):
         LOGGER.info("LoggingHandler handle_state_only: %s", state)
         if state:
-            line = simplejson.dumps(state)
+            line = dumps(state).decode('utf-8')
             state_writer.write(f"{line}\n")
             state_writer.flush()
 
@@ -363,27 +388,48 @@ class LoggingHandler:  # pylint: disable=too-few-public-methods
 
         Serializes records in the same way StitchHandler does, so the
         output file should contain the exact request bodies that we would
-        send to Stitch.
+        send to Stitch. With the msgpack output format the same bodies are
+        written back to back as MessagePack instead, see read_packed_bodies.
 
         '''
         LOGGER.info("LoggingHandler handle_batch")
         LOGGER.info("Saving batch with %d messages for table %s to %s",
                     len(messages), messages[0].stream, self.output_file.name)
-        for i, body in enumerate(serialize(messages,
-                                           schema,
-                                           key_names,
-                                           bookmark_names,
-                                           self.max_batch_bytes,
-                                           self.max_batch_records)):
-            LOGGER.debug("Request body %d is %d bytes", i, len(body))
-            self.output_file.write(body)
-            self.output_file.write('\n')
+        if self.output_format == 'msgpack':
+            for i, body in enumerate(pack(messages,
+                                          schema,
+                                          key_names,
+                                          bookmark_names,
+                                          self.max_batch_bytes,
+                                          self.max_batch_records)):
+                LOGGER.debug("Request body %d is %d bytes", i, len(body))
+                self.output_file.write(body)
+        else:
+            self._write_json_bodies(messages, schema, key_names, bookmark_names)
 
         if state:
-            line = simplejson.dumps(state)
+            line = dumps(state).decode('utf-8')
             state_writer.write(f"{line}\n")
             state_writer.flush()
 
+    def _write_json_bodies(self, messages, schema, key_names, bookmark_names):
+        head, batches, tail = serialize_batches(messages,
+                                                schema,
+                                                key_names,
+                                                bookmark_names,
+                                                self.max_batch_bytes,
+                                                self.max_batch_records)
+        # Write each body piece by piece rather than joining it in memory first
+        for i, batch in enumerate(batches):
+            LOGGER.debug("Request body %d has %d messages", i, len(batch))
+            self.output_file.write(head)
+            for j, encoded in enumerate(batch):
+                if j > 0:
+                    self.output_file.write(b',')
+                self.output_file.write(encoded)
+            self.output_file.write(tail)
+            self.output_file.write(b'\n')
+
 
 
 class ValidatingHandler: # pylint: disable=too-few-public-methods
@@ -391,18 +437,40 @@ class ValidatingHandler: # pylint: disable=too-few-public-methods
 
     def __init__(self):
         getcontext().prec = 76
+        self.format_checker = FormatChecker()
+
+        # Mapping from stream name to the (schema, Draft4Validator) pair for
+        # its current schema. A new schema for the stream replaces the pair.
+        self.validators = {}
+
+    def get_validator(self, stream, schema):
+        '''Returns the cached validator for the stream, rebuilding it if the schema changed.'''
+        cached = self.validators.get(stream)
+        # The schema is usually the very object we cached, from the same
+        # SCHEMA message, so try identity before comparing contents
+        if cached is not None and cached[0] is schema:
+            return cached[1]
+
+        if cached is None or cached[0] != schema:
+            cached = (schema, Draft4Validator(schema, format_checker=self.format_checker))
+        else:
+            # Taps often resend an identical SCHEMA. Hold on to the new
+            # object so that later batches match it by identity again.
+            cached = (schema, cached[1])
+        self.validators[stream] = cached
+        return cached[1]
 
     def handle_state_only(self, state_writer=None, state=None):
         LOGGER.info("ValidatingHandler handle_state_only: %s", state)
         if state:
-            line = simplejson.dumps(state)
+            line = dumps(state).decode('utf-8')
             state_writer.write(f"{line}\n")
             state_writer.flush()
 
     def handle_batch(self, messages, contains_activate_version, schema, key_names, bookmark_names=None, state_writer=None, state=None):
         '''Handles messages by validating them against schema.'''
         LOGGER.info("ValidatingHandler handle_batch")
-        validator = Draft4Validator(schema, format_checker=FormatChecker())
+        validator = self.get_validator(messages[0].stream, schema)
         for i, message in enumerate(messages):
             if isinstance(message, singer.RecordMessage):
                 try:
@@ -423,101 +491,10 @@ class ValidatingHandler: # pylint: disable=too-few-public-methods
                     messages[0].stream,
                     len(messages))
         if state:
-            line = simplejson.dumps(state)
+            line = dumps(state).decode('utf-8')
             state_writer.write(f"{line}\n")
             state_writer.flush()
 
-def generate_sequence(message_num, max_records):
-    '''
-    Generates a unique sequence number based on the current time in nanoseconds
-    with a zero-padded message number based on the index of the record within the
-    magnitude of max_records.
-
-    COMPATIBILITY:
-    Maintains a historical width of 19 characters (with default `max_records`), in order
-    to not overflow downstream processes that depend on the width of this number.
-
-    Because of this requirement, `message_num` is modulo the difference between nanos
-    and millis to maintain 19 characters.
-    '''
-    nanosecond_sequence_base = str(int(time.time() * NANOSECOND_SEQUENCE_MULTIPLIER))
-    modulo = NANOSECOND_SEQUENCE_MULTIPLIER / MILLISECOND_SEQUENCE_MULTIPLIER
-    zfill_width_mod = len(str(NANOSECOND_SEQUENCE_MULTIPLIER)) - len(str(MILLISECOND_SEQUENCE_MULTIPLIER))
-
-    # add an extra order of magnitude to account for the fact that we can
-    # actually accept more than the max record count
-    fill = len(str(10 * max_records)) - zfill_width_mod
-    sequence_suffix = str(int(message_num % modulo)).zfill(fill)
-
-    return int(nanosecond_sequence_base + sequence_suffix)
-
-def serialize(messages, schema, key_names, bookmark_names, max_bytes, max_records):
-    '''Produces request bodies for Stitch.
-
-    Builds a request body consisting of all the messages. Serializes it as
-    JSON. If the result exceeds the request size limit, splits the batch
-    in half and recurs.
-
-    '''
-    serialized_messages = []
-    for idx, message in enumerate(messages):
-        if isinstance(message, singer.RecordMessage):
-            record_message = {
-                'action': 'upsert',
-                'data': message.record,
-                'sequence': generate_sequence(idx, max_records)
-            }
-
-            if message.time_extracted:
-                #"%04Y-%m-%dT%H:%M:%S.%fZ"
-                record_message['time_extracted'] = singer.utils.strftime(message.time_extracted)
-
-            serialized_messages.append(record_message)
-        elif isinstance(message, singer.ActivateVersionMessage):
-            serialized_messages.append({
-                'action': 'activate_version',
-                'sequence': generate_sequence(idx, max_records)
-            })
-
-    body = {
-        'table_name': messages[0].stream,
-        'schema': schema,
-        'key_names': key_names,
-        'messages': serialized_messages
-    }
-    if messages[0].version is not None:
-        body['table_version'] = messages[0].version
-
-    if bookmark_names:
-        body['bookmark_names'] = bookmark_names
-
-
-    # We are not using Decimals for parsing here. We recognize that
-    # exposes data to potential rounding errors. However, the Stitch API
-    # as it is implemented currently is also subject to rounding errors.
-    # This will affect very few data points and we have chosen to leave
-    # conversion as is for now.
-
-    serialized = simplejson.dumps(body)
-    LOGGER.debug('Serialized %d messages into %d bytes', len(messages), len(serialized))
-
-    if len(serialized) < max_bytes:
-        return [serialized]
-
-    if len(messages) <= 1:
-        if len(serialized) < BIGBATCH_MAX_BATCH_BYTES:
-            return [serialized]
-        raise BatchTooLargeException(
-            f"A single record is larger than the Stitch API limit of {BIGBATCH_MAX_BATCH_BYTES // 1000000} Mb"
-        )
-
-
-    pivot = len(messages) // 2
-    l_half = serialize(messages[:pivot], schema, key_names, bookmark_names, max_bytes, max_records)
-    r_half = serialize(messages[pivot:], schema, key_names, bookmark_names, max_bytes, max_records)
-    return l_half + r_half
-
-
 class TargetStitch:
     '''Encapsulates most of the logic of target-stitch.
 
@@ -537,6 +514,11 @@ class TargetStitch:
         self.buffer_size_bytes = {}
         self.state = None
 
+        # Running totals of buffer_size_bytes and of the buffered messages
+        # across all streams, so we don't have to sum them for every record
+        self.total_buffer_size_bytes = 0
+        self.total_buffered_messages = 0
+
         # Mapping from stream name to {'schema': ..., 'key_names': ..., 'bookmark_names': ... }
         self.stream_meta = {}
 
@@ -586,6 +568,8 @@ class TargetStitch:
 
         self.time_last_batch_sent = time.time()
         self.contains_activate_version[stream] = False
+        self.total_buffer_size_bytes -= self.buffer_size_bytes.get(stream, 0)
+        self.total_buffered_messages -= len(messages)
         self.buffer_size_bytes[stream] = 0
         self.messages[stream] = []
         # NB: We can only clear the state if this is the final stream
@@ -605,6 +589,8 @@ class TargetStitch:
             num_flushed += 1
             is_final_stream = num_flushed == num_streams
             self.flush_stream(stream, is_final_stream)
+        if num_flushed > 0:
+            log_memory_usage()
         # NB> State is usually handled above but in the case there are no messages
         # we still want to ensure state is emitted.
         if num_flushed == 0 and self.state:
@@ -612,6 +598,7 @@ class TargetStitch:
                 handler.handle_state_only(self.state_writer, self.state)
             self.state = None
             TIMINGS.log_timings()
+            log_memory_usage()
 
 
 
@@ -643,16 +630,21 @@ class TargetStitch:
             # NB> This previously would flush on a stream change. Because
             # we are now buffering records across streams we do not need
             # to flush on stream change
-            if self.messages[current_stream] and (message.version != self.messages[current_stream][0].version):
+            stream_messages = self.messages[current_stream]
+            if stream_messages and (message.version != stream_messages[0].version):
                 self.flush()
+                # flush() replaces the buffer for every stream it flushed
+                stream_messages = self.messages[current_stream]
 
-            self.messages[current_stream].append(message)
+            stream_messages.append(message)
             self.buffer_size_bytes[current_stream] = self.buffer_size_bytes.get(current_stream, 0) + len(line)
+            self.total_buffer_size_bytes += len(line)
+            self.total_buffered_messages += 1
             if isinstance(message, singer.ActivateVersionMessage):
                 self.contains_activate_version[current_stream] = True
 
-            num_bytes = sum(self.buffer_size_bytes.values())
-            num_messages = sum((len(messages) for messages in self.messages.values()))
+            num_bytes = self.total_buffer_size_bytes
+            num_messages = self.total_buffered_messages
             num_seconds = time.time() - self.time_last_batch_sent
 
             enough_bytes = num_bytes >= self.max_batch_bytes
@@ -672,8 +664,8 @@ class TargetStitch:
 
             if num_seconds >= self.batch_delay_seconds:
                 LOGGER.debug('Flushing %d bytes, %d messages, after %.2f seconds',
-                             sum(self.buffer_size_bytes.values()),
-                             sum(len(messages) for messages in self.messages.values()), num_seconds)
+                             self.total_buffer_size_bytes,
+                             self.total_buffered_messages, num_seconds)
                 self.flush()
                 self.time_last_batch_sent = time.time()
 
@@ -689,6 +681,12 @@ class TargetStitch:
 def collect():
     '''Send usage info to Stitch.'''
 
+    # These are only needed here, and pkg_resources in particular is slow
+    # to import, so we keep them off the startup path
+    import http.client # pylint: disable=import-outside-toplevel
+    import urllib.parse # pylint: disable=import-outside-toplevel
+    import pkg_resources # pylint: disable=import-outside-toplevel
+
     try:
         version = pkg_resources.get_distribution('target-stitch').version
         conn = http.client.HTTPSConnection('collector.stitchdata.com', timeout=10)
@@ -722,7 +720,12 @@ def main_impl():
     parser.add_argument(
         '-o', '--output-file',
         help='Save requests to this output file',
-        type=argparse.FileType('w'))
+        type=argparse.FileType('wb'))
+    parser.add_argument(
+        '--output-format',
+        help='Format of the requests saved to the output file',
+        choices=['json', 'msgpack'],
+        default='json')
     parser.add_argument(
         '-v', '--verbose',
         help='Produce debug-level logging',
@@ -741,11 +744,15 @@ def main_impl():
     elif args.quiet:
         LOGGER.setLevel('WARNING')
 
+    if args.output_format == 'msgpack' and not HAS_MSGPACK:
+        parser.error("the msgpack output format requires the msgpack package")
+
     handlers = []
     if args.output_file:
         handlers.append(LoggingHandler(args.output_file,
                                        args.max_batch_bytes,
-                                       args.max_batch_records))
+                                       args.max_batch_records,
+                                       args.output_format))
     if args.dry_run:
         handlers.append(ValidatingHandler())
     elif not args.config:
@@ -762,7 +769,9 @@ def main_impl():
                                       args.max_batch_records))
 
     # queue = Queue(args.max_batch_records)
-    reader = io.TextIOWrapper(sys.stdin.buffer, encoding='utf-8')
+    stdin = io.BufferedReader(io.FileIO(sys.stdin.fileno(), closefd=False),
+                              buffer_size=STDIN_BUFFER_BYTES)
+    reader = io.TextIOWrapper(stdin, encoding='utf-8')
     target_stitch = TargetStitch(handlers,
                                  sys.stdout,
                                  args.max_batch_bytes,
@@ -782,9 +791,12 @@ def finish_requests(max_count=0):
     while True:
         # LOGGER.info("Finishing %s requests:", len(PENDING_REQUESTS))
         check_send_exception()
-        if len(PENDING_REQUESTS) <= max_count: #pylint: disable=len-as-condition
-            break
-        time.sleep(1 / 1000.0)
+        with REQUESTS_CHANGED:
+            if len(PENDING_REQUESTS) <= max_count: #pylint: disable=len-as-condition
+                break
+            #flush_states notifies us as requests complete. The timeout is
+            #only a safety net in case a notification is ever missed.
+            REQUESTS_CHANGED.wait(1.0)
 
 
 
@@ -802,10 +814,14 @@ def check_send_exception():
     # stringified response.
     except StitchClientResponseError as exc:
         try:
-            msg = f"{str(exc.status)}: {exc.response_body}"
+            # The body was already parsed as json in post_coroutine
+            response_body = exc.response_body
+            if isinstance(response_body, dict) and response_body.get('message'):
+                response_body = response_body['message']
+            msg = f"{str(exc.status)}: {response_body}"
         except Exception: # pylint: disable=bare-except
             LOGGER.exception('Exception while processing error response')
-            msg = f'{exc}'
+            msg = f'{exc.status}'
         raise TargetStitchException('Error persisting data to Stitch: ' +
                                     msg) from exc
 
@@ -817,17 +833,36 @@ def check_send_exception():
         LOGGER.exception(exc)
         raise TargetStitchException('Error connecting to Stitch') from exc
 
+    # A ServerDisconnectedError means Stitch closed the connection before
+    # responding, even after retrying.
+    except ServerDisconnectedError as exc:
+        raise TargetStitchException('Stitch closed the connection') from exc
+
+    # A ClientOSError (after the ClientConnectorError case above) means the
+    # connection failed mid-request, typically reset by the server, even
+    # after retrying.
+    except ClientOSError as exc:
+        LOGGER.exception(exc)
+        raise TargetStitchException('Connection to Stitch was reset') from exc
+
     except concurrent.futures._base.TimeoutError as exc: #pylint: disable=protected-access
         raise TargetStitchException("Timeout sending to Stitch") from exc
 
 
 def exception_is_4xx(ex):
-    return 400 <= ex.status < 500
+    return isinstance(ex, StitchClientResponseError) and 400 <= ex.status < 500
 
+def should_give_up(ex):
+    # ClientConnectorError is a ClientOSError too, but failing to connect at
+    # all is reported straight away rather than retried
+    return exception_is_4xx(ex) or isinstance(ex, ClientConnectorError)
+
+# A keep-alive connection can be closed or reset by the server just as we
+# reuse it, which is safe to retry like a 5xx
 @backoff.on_exception(backoff.expo,
-                      StitchClientResponseError,
+                      (StitchClientResponseError, ServerDisconnectedError, ClientOSError),
                       max_tries=5,
-                      giveup=exception_is_4xx,
+                      giveup=should_give_up,
                       on_backoff=_log_backoff)
 async def post_coroutine(url, headers, data, verify_ssl):
     # LOGGER.info("POST starting: %s ssl(%s)", url, verify_ssl)
@@ -844,6 +879,12 @@ async def post_coroutine(url, headers, data, verify_ssl):
 
         return result_body
 
+# simplejson.loads(..., use_decimal=True) builds a new decoder on every
+# call, so we build ours once and reuse it for every line. NaN and
+# Infinity are decoded as Decimals too, so that they are written back out
+# verbatim rather than as the null orjson emits for non-finite floats.
+DECIMAL_DECODER = simplejson.JSONDecoder(parse_float=Decimal, parse_constant=Decimal)
+
 def _required_key(msg, k):
     if k not in msg:
         raise Exception(f"Message is missing required key '{k}': {msg}")
@@ -858,7 +899,7 @@ def overloaded_parse_message(msg):
     # lossy conversions.  However, this will affect
     # very few data points and we have chosen to
     # leave conversion as is for now.
-    obj = simplejson.loads(msg, use_decimal=True)
+    obj = DECIMAL_DECODER.decode(msg)
     msg_type = _required_key(obj, 'type')
 
     if msg_type == 'RECORD':
@@ -891,7 +932,6 @@ def overloaded_parse_message(msg):
 def main():
     '''Main entry point'''
     try:
-        MemoryReporter().start()
         main_impl()
 
     # If we catch an exception at the top level we want to log a CRITICAL
@@ -0,0 +1,259 @@
+# pylint: disable=too-many-arguments,line-too-long
+
+'''
+Encoding of Singer messages into Stitch request bodies, as JSON for the
+Import API or as MessagePack for local output files.
+'''
+
+import time
+from decimal import Decimal
+
+import orjson
+import simplejson
+import singer
+
+from target_stitch.exceptions import TargetStitchException, BatchTooLargeException
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+HAS_MSGPACK = msgpack is not None
+
+LOGGER = singer.get_logger().getChild('target_stitch')
+
+BIGBATCH_MAX_BATCH_BYTES = 20000000
+MILLISECOND_SEQUENCE_MULTIPLIER = 1000
+NANOSECOND_SEQUENCE_MULTIPLIER = 1000000
+MSGPACK_DECIMAL_EXT_TYPE = 1
+MSGPACK_INT_EXT_TYPE = 2
+
+def _orjson_default(obj):
+    # Decimals are emitted verbatim as JSON numbers so that we never lose
+    # precision on the values we parsed with use_decimal=True.
+    if isinstance(obj, Decimal):
+        return orjson.Fragment(str(obj))
+    raise TypeError(f'Object of type {type(obj).__name__} is not JSON serializable')
+
+def dumps(obj):
+    '''Serializes obj as compact JSON, returning UTF-8 encoded bytes.
+
+    orjson is much faster than simplejson but refuses integers wider than
+    64 bits, so we fall back to simplejson for those.
+    '''
+    try:
+        return orjson.dumps(obj, default=_orjson_default)
+    except orjson.JSONEncodeError:
+        return simplejson.dumps(obj, separators=(',', ':')).encode('utf-8')
+
+def generate_sequence(message_num, max_records, now=None):
+    '''
+    Generates a unique sequence number based on the current time in nanoseconds
+    with a zero-padded message number based on the index of the record within the
+    magnitude of max_records.
+
+    COMPATIBILITY:
+    Maintains a historical width of 19 characters (with default `max_records`), in order
+    to not overflow downstream processes that depend on the width of this number.
+
+    Because of this requirement, `message_num` is modulo the difference between nanos
+    and millis to maintain 19 characters. The time base is advanced by one unit for
+    every time `message_num` wraps, so sequences stay increasing within a batch even
+    when the clock has not moved.
+
+    Callers generating a whole batch of sequences can sample the clock once and
+    pass it as `now`.
+    '''
+    if now is None:
+        now = time.time()
+    modulo = NANOSECOND_SEQUENCE_MULTIPLIER / MILLISECOND_SEQUENCE_MULTIPLIER
+    nanosecond_sequence_base = str(int(now * NANOSECOND_SEQUENCE_MULTIPLIER) + int(message_num // modulo))
+    zfill_width_mod = len(str(NANOSECOND_SEQUENCE_MULTIPLIER)) - len(str(MILLISECOND_SEQUENCE_MULTIPLIER))
+
+    # add an extra order of magnitude to account for the fact that we can
+    # actually accept more than the max record count
+    fill = len(str(10 * max_records)) - zfill_width_mod
+    sequence_suffix = str(int(message_num % modulo)).zfill(fill)
+
+    return int(nanosecond_sequence_base + sequence_suffix)
+
+def _body_envelope(messages, schema, key_names, bookmark_names):
+    '''Returns every field of a request body except its messages.'''
+    envelope = {
+        'table_name': messages[0].stream,
+        'schema': schema,
+        'key_names': key_names
+    }
+    if messages[0].version is not None:
+        envelope['table_version'] = messages[0].version
+
+    if bookmark_names:
+        envelope['bookmark_names'] = bookmark_names
+
+    return envelope
+
+def _split_encoded(encoded_messages, overhead, separator_bytes, max_bytes):
+    '''Greedily packs encoded messages into batches that fit under max_bytes.
+
+    overhead is the size of everything in a body other than its messages
+    and separator_bytes is the size of whatever goes between two messages.
+    A message that cannot fit alongside others gets a batch of its own as
+    long as it is within the big batch limit.
+
+    '''
+    batches = []
+    batch = []
+    batch_bytes = overhead
+    for encoded in encoded_messages:
+        if batch and batch_bytes + separator_bytes + len(encoded) >= max_bytes:
+            batches.append(batch)
+            batch = []
+            batch_bytes = overhead
+
+        if not batch and overhead + len(encoded) >= BIGBATCH_MAX_BATCH_BYTES:
+            raise BatchTooLargeException(
+                f"A single record is larger than the Stitch API limit of {BIGBATCH_MAX_BATCH_BYTES // 1000000} Mb"
+            )
+
+        batch_bytes += len(encoded) + (separator_bytes if batch else 0)
+        batch.append(encoded)
+
+    if batch or not batches:
+        batches.append(batch)
+
+    return batches
+
+# The envelope around each message has a fixed shape, so we write it out
+# directly and only hand the record itself to the JSON encoder
+def _encode_upsert(message, sequence):
+    if message.time_extracted:
+        #"%04Y-%m-%dT%H:%M:%S.%fZ"
+        time_extracted = singer.utils.strftime(message.time_extracted).encode('utf-8')
+        prefix = b'{"action":"upsert","sequence":%d,"time_extracted":"%s","data":' % (sequence, time_extracted)
+    else:
+        prefix = b'{"action":"upsert","sequence":%d,"data":' % sequence
+
+    return prefix + dumps(message.record) + b'}'
+
+def _encode_activate_version(message, sequence):
+    return b'{"action":"activate_version","sequence":%d}' % sequence
+
+# Looked up by exact message type, which saves an isinstance chain per message
+MESSAGE_ENCODERS = {
+    singer.RecordMessage: _encode_upsert,
+    singer.ActivateVersionMessage: _encode_activate_version,
+}
+
+def serialize_batches(messages, schema, key_names, bookmark_names, max_bytes, max_records):
+    '''Serializes each message exactly once and packs the results into batches.
+
+    Returns a tuple of (head, batches, tail) where each batch is a list of
+    encoded messages. A request body is head + b','.join(batch) + tail.
+
+    '''
+    # Sample the clock once for the whole batch rather than once per message
+    now = time.time()
+    encoded_messages = []
+    for idx, message in enumerate(messages):
+        encode = MESSAGE_ENCODERS.get(type(message))
+        if encode is not None:
+            encoded_messages.append(encode(message, generate_sequence(idx, max_records, now)))
+
+    # We are not using Decimals for parsing here. We recognize that
+    # exposes data to potential rounding errors. However, the Stitch API
+    # as it is implemented currently is also subject to rounding errors.
+    # This will affect very few data points and we have chosen to leave
+    # conversion as is for now.
+
+    # The messages array is spliced onto the end of the envelope so the
+    # envelope itself only has to be serialized once per batch.
+    head = dumps(_body_envelope(messages, schema, key_names, bookmark_names))[:-1] + b',"messages":['
+    tail = b']}'
+    batches = _split_encoded(encoded_messages, len(head) + len(tail), 1, max_bytes)
+
+    return head, batches, tail
+
+def serialize(messages, schema, key_names, bookmark_names, max_bytes, max_records):
+    '''Produces request bodies for Stitch.
+
+    Serializes each message once, then greedily packs as many of them as
+    will fit under max_bytes into each request body. A single message that
+    does not fit is sent on its own as long as it is within the big batch
+    limit.
+
+    '''
+    head, batches, tail = serialize_batches(messages,
+                                            schema,
+                                            key_names,
+                                            bookmark_names,
+                                            max_bytes,
+                                            max_records)
+    bodies = [head + b','.join(batch) + tail for batch in batches]
+    LOGGER.debug('Serialized %d messages into %d bytes', len(messages), sum(len(body) for body in bodies))
+    return bodies
+
+
+def _msgpack_default(obj):
+    # Decimals and integers too wide for MessagePack are stored as their
+    # exact string form in an extension type so that replaying a file does
+    # not lose precision
+    if isinstance(obj, Decimal):
+        return msgpack.ExtType(MSGPACK_DECIMAL_EXT_TYPE, str(obj).encode('utf-8'))
+    if isinstance(obj, int):
+        return msgpack.ExtType(MSGPACK_INT_EXT_TYPE, str(obj).encode('utf-8'))
+    raise TypeError(f'Object of type {type(obj).__name__} is not MessagePack serializable')
+
+def _msgpack_ext_hook(code, data):
+    if code == MSGPACK_DECIMAL_EXT_TYPE:
+        return Decimal(data.decode('utf-8'))
+    if code == MSGPACK_INT_EXT_TYPE:
+        return int(data)
+    return msgpack.ExtType(code, data)
+
+def _message_dict(message, sequence):
+    '''Returns the Stitch message as a dict, with the same fields in the same
+    order as the JSON encoders write.'''
+    if isinstance(message, singer.RecordMessage):
+        stitch_message = {'action': 'upsert', 'sequence': sequence}
+        if message.time_extracted:
+            stitch_message['time_extracted'] = singer.utils.strftime(message.time_extracted)
+        stitch_message['data'] = message.record
+        return stitch_message
+
+    return {'action': 'activate_version', 'sequence': sequence}
+
+def pack(messages, schema, key_names, bookmark_names, max_bytes, max_records):
+    '''Produces MessagePack encoded request bodies.
+
+    This is the MessagePack counterpart of serialize(). The bodies have the
+    same fields and are split the same way, using the packed size of the
+    messages.
+
+    '''
+    if not HAS_MSGPACK:
+        raise TargetStitchException('The msgpack output format requires the msgpack package')
+
+    packer = msgpack.Packer(default=_msgpack_default)
+    now = time.time()
+    # MESSAGE_ENCODERS decides which messages are sent in either format
+    packed_messages = [packer.pack(_message_dict(message, generate_sequence(idx, max_records, now)))
+                       for idx, message in enumerate(messages)
+                       if type(message) in MESSAGE_ENCODERS]
+
+    envelope = _body_envelope(messages, schema, key_names, bookmark_names)
+    head = packer.pack_map_header(len(envelope) + 1)
+    for key, value in envelope.items():
+        head += packer.pack(key) + packer.pack(value)
+    head += packer.pack('messages')
+
+    # An array header takes at most 5 bytes
+    batches = _split_encoded(packed_messages, len(head) + 5, 0, max_bytes)
+    return [head + packer.pack_array_header(len(batch)) + b''.join(batch) for batch in batches]
+
+def read_packed_bodies(input_file):
+    '''Yields the request bodies from a file written with --output-format msgpack.'''
+    if not HAS_MSGPACK:
+        raise TargetStitchException('Reading msgpack output requires the msgpack package')
+
+    yield from msgpack.Unpacker(input_file, ext_hook=_msgpack_ext_hook, raw=False)
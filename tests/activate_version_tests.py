@@ -70,21 +70,6 @@ class ActivateVersion(unittest.TestCase):
         self.first_flush_error = None
         self.second_flush_error = None
 
-        handler = StitchHandler(target_stitch.DEFAULT_MAX_BATCH_BYTES, 2)
-
-        self.out = io.StringIO()
-        self.target_stitch = target_stitch.TargetStitch(
-            [handler], self.out, 4000000, 2, 100000)
-        self.queue = [simplejson.dumps({"type": "SCHEMA", "stream": "chicken_stream",
-                                  "key_properties": ["my_float"],
-                                  "schema": {"type": "object",
-                                             "properties": {"my_float": {"type": "number"}}}})]
-        target_stitch.SEND_EXCEPTION = None
-        target_stitch.PENDING_REQUESTS = []
-        self.og_flush_states = StitchHandler.flush_states
-        self.flushed_state_count = 0
-        StitchHandler.flush_states = self.fake_flush_states
-
         target_stitch.CONFIG = {
             'token': "some-token",
             'client_id': "some-client",
@@ -100,6 +85,21 @@ class ActivateVersion(unittest.TestCase):
             'big_batch_url' : "http://big-batch",
         }
 
+        handler = StitchHandler(target_stitch.DEFAULT_MAX_BATCH_BYTES, 2)
+
+        self.out = io.StringIO()
+        self.target_stitch = target_stitch.TargetStitch(
+            [handler], self.out, 4000000, 2, 100000)
+        self.queue = [simplejson.dumps({"type": "SCHEMA", "stream": "chicken_stream",
+                                  "key_properties": ["my_float"],
+                                  "schema": {"type": "object",
+                                             "properties": {"my_float": {"type": "number"}}}})]
+        target_stitch.SEND_EXCEPTION = None
+        target_stitch.PENDING_REQUESTS = []
+        self.og_flush_states = StitchHandler.flush_states
+        self.flushed_state_count = 0
+        StitchHandler.flush_states = self.fake_flush_states
+
     def test_activate_version_finishes_pending_requests(self):
         target_stitch.OUR_SESSION = FakeSession(mock_out_of_order_all_200)
         #request 2 would ordinarily complete first because the mock_out_of_order_all_200, but because
@@ -1,4 +1,5 @@
 import asyncio
+from aiohttp.client_exceptions import ClientOSError, ServerDisconnectedError
 
 def mock_unparsable_response_body_200(requests_sent):
     class FakeResponse:
@@ -124,3 +125,15 @@ def mock_in_order_both_error(requests_sent):
             return {"status" : "finished request {}".format(requests_sent)}
 
     return FakeResponse(requests_sent)
+
+def mock_first_disconnects(requests_sent):
+    if requests_sent == 1:
+        raise ServerDisconnectedError()
+
+    return mock_in_order_all_200(requests_sent)
+
+def mock_first_resets(requests_sent):
+    if requests_sent == 1:
+        raise ClientOSError(104, 'Connection reset by peer')
+
+    return mock_in_order_all_200(requests_sent)
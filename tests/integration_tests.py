@@ -6,6 +6,7 @@ import io
 import os
 import json
 import asyncio
+import gzip
 import simplejson
 import collections
 import time
@@ -21,6 +22,8 @@ try:
         mock_out_of_order_both_error,
         mock_in_order_both_error,
         mock_unparsable_response_body_200,
+        mock_first_disconnects,
+        mock_first_resets,
     )
 except ImportError:
     from gate_mocks import (
@@ -33,6 +36,8 @@ except ImportError:
         mock_out_of_order_both_error,
         mock_in_order_both_error,
         mock_unparsable_response_body_200,
+        mock_first_disconnects,
+        mock_first_resets,
     )
 
 from nose.tools import nottest
@@ -43,8 +48,13 @@ def fake_check_send_exception():
     return None
 
 def load_sample_lines(filename):
+    # Split on '\n' only, as iterating the file does. str.splitlines would
+    # also break on characters like '\u2028' that are legal in JSON strings.
     with open('tests/' + filename) as fp:
-        return [line for line in fp]
+        lines = fp.read().split('\n')
+    if lines[-1]:
+        return [line + '\n' for line in lines[:-1]] + [lines[-1]]
+    return [line + '\n' for line in lines[:-1]]
 
 class FakePost:
     def __init__(self, requests_sent, makeFakeResponse):
@@ -63,10 +73,15 @@ class FakeSession:
         self.urls = []
         self.messages_sent = []
         self.bodies_sent = []
+        self.headers_sent = []
         self.makeFakeResponse = makeFakeResponse
 
     def post(self, url, *, data, **kwargs):
-        data_json = simplejson.loads(data)
+        self.headers_sent.append(kwargs.get('headers'))
+        if kwargs.get('headers', {}).get('Content-Encoding') == 'gzip':
+            data_json = simplejson.loads(gzip.decompress(data))
+        else:
+            data_json = simplejson.loads(data)
         self.messages_sent.append(data_json["messages"])
         self.requests_sent = self.requests_sent + 1
         self.bodies_sent.append(data)
@@ -77,6 +92,21 @@ class FakeSession:
 class AsyncSerializeFloats(unittest.TestCase):
     def setUp(self):
         token = None
+        target_stitch.CONFIG = {
+            'token': "some-token",
+            'client_id': "some-client",
+            'disable_collection': True,
+            'connection_ns': "some-ns",
+            'batch_size_preferences' : {
+                'full_table_streams' : [],
+                'batch_size_preference': None,
+                'user_batch_size_preference': None,
+            },
+            'turbo_boost_factor' : 10,
+            'small_batch_url' : "http://small-batch",
+            'big_batch_url' : "http://big-batch",
+        }
+
         handler = StitchHandler(target_stitch.DEFAULT_MAX_BATCH_BYTES, 2)
 
         self.out = io.StringIO()
@@ -93,21 +123,6 @@ class AsyncSerializeFloats(unittest.TestCase):
                     target_stitch.SEND_EXCEPTION,
                     target_stitch.PENDING_REQUESTS)
 
-        target_stitch.CONFIG = {
-            'token': "some-token",
-            'client_id': "some-client",
-            'disable_collection': True,
-            'connection_ns': "some-ns",
-            'batch_size_preferences' : {
-                'full_table_streams' : [],
-                'batch_size_preference': None,
-                'user_batch_size_preference': None,
-            },
-            'turbo_boost_factor' : 10,
-            'small_batch_url' : "http://small-batch",
-            'big_batch_url' : "http://big-batch",
-        }
-
 
     def test_serialize_floats(self):
         floats = [
@@ -155,6 +170,21 @@ class AsyncSerializeFloats(unittest.TestCase):
 class AsyncPushToGate(unittest.TestCase):
     def setUp(self):
         token = None
+        target_stitch.CONFIG ={
+            'token': "some-token",
+            'client_id': "some-client",
+            'disable_collection': True,
+            'connection_ns': "some-ns",
+            'batch_size_preferences' : {
+                'full_table_streams' : [],
+                'batch_size_preference': None,
+                'user_batch_size_preference': None,
+            },
+            'turbo_boost_factor' : 10,
+            'small_batch_url' : "http://small-batch",
+            'big_batch_url' : "http://big-batch",
+        }
+
         handler = StitchHandler(target_stitch.DEFAULT_MAX_BATCH_BYTES, 2)
 
         self.og_check_send_exception = target_stitch.check_send_exception
@@ -179,21 +209,6 @@ class AsyncPushToGate(unittest.TestCase):
                     target_stitch.SEND_EXCEPTION,
                     target_stitch.PENDING_REQUESTS)
 
-        target_stitch.CONFIG ={
-            'token': "some-token",
-            'client_id': "some-client",
-            'disable_collection': True,
-            'connection_ns': "some-ns",
-            'batch_size_preferences' : {
-                'full_table_streams' : [],
-                'batch_size_preference': None,
-                'user_batch_size_preference': None,
-            },
-            'turbo_boost_factor' : 10,
-            'small_batch_url' : "http://small-batch",
-            'big_batch_url' : "http://big-batch",
-        }
-
     # 2 requests
     # both with state
     # in order responses
@@ -217,6 +232,56 @@ class AsyncPushToGate(unittest.TestCase):
         self.assertEqual( emitted_state[0], {'bookmarks': {'chicken_stream': {'id': 1}}})
         self.assertEqual( emitted_state[1], {'bookmarks': {'chicken_stream': {'id': 3}}})
 
+    def test_compresses_large_requests(self):
+        target_stitch.OUR_SESSION = FakeSession(mock_in_order_all_200)
+        target_stitch.CONFIG['compress_requests'] = True
+        self.queue.append(json.dumps({"type": "RECORD", "stream": "chicken_stream", "record": {"id": 1, "name": "M" * 20000}}))
+        self.queue.append(json.dumps({"type": "RECORD", "stream": "chicken_stream", "record": {"id": 2, "name": "Paul"}}))
+        #will flush here after 2 records
+        self.queue.append(json.dumps({"type": "RECORD", "stream": "chicken_stream", "record": {"id": 3, "name": "Harrsion"}}))
+        #will flush here at the end
+
+        self.target_stitch.consume(self.queue)
+        finish_requests()
+
+        encodings = [headers.get('Content-Encoding') for headers in target_stitch.OUR_SESSION.headers_sent]
+        self.assertEqual(encodings, ['gzip', None])
+        self.assertEqual([headers['Authorization'] for headers in target_stitch.OUR_SESSION.headers_sent],
+                         ['Bearer some-token', 'Bearer some-token'])
+        self.assertLess(len(target_stitch.OUR_SESSION.bodies_sent[0]), 20000)
+        self.assertEqual([[m['data']['id'] for m in ms] for ms in target_stitch.OUR_SESSION.messages_sent],
+                         [[1, 2], [3]])
+
+    def test_retries_when_server_disconnects(self):
+        target_stitch.OUR_SESSION = FakeSession(mock_first_disconnects)
+        self.queue.append(json.dumps({"type": "RECORD", "stream": "chicken_stream", "record": {"id": 1, "name": "Mike"}}))
+        self.queue.append(json.dumps({"type": "RECORD", "stream": "chicken_stream", "record": {"id": 2, "name": "Paul"}}))
+        #will flush here after 2 records
+        self.queue.append(json.dumps({"type":"STATE", "value":{"bookmarks":{"chicken_stream":{"id": 2}}}}))
+
+        self.target_stitch.consume(self.queue)
+        finish_requests()
+
+        # Retries left over from earlier tests may also land on this session
+        self.assertGreaterEqual(target_stitch.OUR_SESSION.requests_sent, 2)
+        emitted_state = list(map(json.loads, self.out.getvalue().strip().split('\n')))
+        self.assertEqual(emitted_state, [{'bookmarks': {'chicken_stream': {'id': 2}}}])
+
+    def test_retries_when_connection_resets(self):
+        target_stitch.OUR_SESSION = FakeSession(mock_first_resets)
+        self.queue.append(json.dumps({"type": "RECORD", "stream": "chicken_stream", "record": {"id": 1, "name": "Mike"}}))
+        self.queue.append(json.dumps({"type": "RECORD", "stream": "chicken_stream", "record": {"id": 2, "name": "Paul"}}))
+        #will flush here after 2 records
+        self.queue.append(json.dumps({"type":"STATE", "value":{"bookmarks":{"chicken_stream":{"id": 2}}}}))
+
+        self.target_stitch.consume(self.queue)
+        finish_requests()
+
+        # Retries left over from earlier tests may also land on this session
+        self.assertGreaterEqual(target_stitch.OUR_SESSION.requests_sent, 2)
+        emitted_state = list(map(json.loads, self.out.getvalue().strip().split('\n')))
+        self.assertEqual(emitted_state, [{'bookmarks': {'chicken_stream': {'id': 2}}}])
+
     def test_request_to_big_batch_for_large_record(self):
         target_stitch.OUR_SESSION = FakeSession(mock_in_order_all_200)
         self.target_stitch.max_batch_records = 4
@@ -523,6 +588,21 @@ class AsyncPushToGate(unittest.TestCase):
 class StateOnly(unittest.TestCase):
     def setUp(self):
         token = None
+        target_stitch.CONFIG ={
+            'token': "some-token",
+            'client_id': "some-client",
+            'disable_collection': True,
+            'connection_ns': "some-ns",
+            'batch_size_preferences' : {
+                'full_table_streams' : [],
+                'batch_size_preference': None,
+                'user_batch_size_preference': None,
+            },
+            'turbo_boost_factor' : 10,
+            'small_batch_url' : "http://small-batch",
+            'big_batch_url' : "http://big-batch",
+        }
+
         handler = StitchHandler(target_stitch.DEFAULT_MAX_BATCH_BYTES, 2)
         self.og_check_send_exception = target_stitch.check_send_exception
         self.out = io.StringIO()
@@ -540,20 +620,6 @@ class StateOnly(unittest.TestCase):
         LOGGER.info("cleaning SEND_EXCEPTIONS: %s AND PENDING_REQUESTS: %s",
                     target_stitch.SEND_EXCEPTION,
                     target_stitch.PENDING_REQUESTS)
-        target_stitch.CONFIG ={
-            'token': "some-token",
-            'client_id': "some-client",
-            'disable_collection': True,
-            'connection_ns': "some-ns",
-            'batch_size_preferences' : {
-                'full_table_streams' : [],
-                'batch_size_preference': None,
-                'user_batch_size_preference': None,
-            },
-            'turbo_boost_factor' : 10,
-            'small_batch_url' : "http://small-batch",
-            'big_batch_url' : "http://big-batch",
-        }
 
     def test_state_only(self):
         target_stitch.OUR_SESSION = FakeSession(mock_in_order_all_200)
@@ -570,21 +636,6 @@ class StateOnly(unittest.TestCase):
 class StateEdgeCases(unittest.TestCase):
     def setUp(self):
         token = None
-        handler = StitchHandler(target_stitch.DEFAULT_MAX_BATCH_BYTES, 2)
-        self.out = io.StringIO()
-        self.target_stitch = target_stitch.TargetStitch(
-            [handler], self.out, 4000000, 2, 100000)
-        self.queue = [simplejson.dumps({"type": "SCHEMA", "stream": "chicken_stream",
-                                  "key_properties": ["my_float"],
-                                  "schema": {"type": "object",
-                                             "properties": {"my_float": {"type": "number"}}}})]
-        target_stitch.SEND_EXCEPTION = None
-        target_stitch.PENDING_REQUESTS = []
-
-        LOGGER.info("cleaning SEND_EXCEPTIONS: %s AND PENDING_REQUESTS: %s",
-                    target_stitch.SEND_EXCEPTION,
-                    target_stitch.PENDING_REQUESTS)
-
         target_stitch.CONFIG ={
             'token': "some-token",
             'client_id': "some-client",
@@ -600,6 +651,21 @@ class StateEdgeCases(unittest.TestCase):
             'big_batch_url' : "http://big-batch",
         }
 
+        handler = StitchHandler(target_stitch.DEFAULT_MAX_BATCH_BYTES, 2)
+        self.out = io.StringIO()
+        self.target_stitch = target_stitch.TargetStitch(
+            [handler], self.out, 4000000, 2, 100000)
+        self.queue = [simplejson.dumps({"type": "SCHEMA", "stream": "chicken_stream",
+                                  "key_properties": ["my_float"],
+                                  "schema": {"type": "object",
+                                             "properties": {"my_float": {"type": "number"}}}})]
+        target_stitch.SEND_EXCEPTION = None
+        target_stitch.PENDING_REQUESTS = []
+
+        LOGGER.info("cleaning SEND_EXCEPTIONS: %s AND PENDING_REQUESTS: %s",
+                    target_stitch.SEND_EXCEPTION,
+                    target_stitch.PENDING_REQUESTS)
+
 
     def test_trailing_state_after_final_message(self):
         target_stitch.OUR_SESSION = FakeSession(mock_in_order_all_200)
@@ -653,6 +719,21 @@ class BufferingPerStreamConstraints(unittest.TestCase):
     def setUp(self):
         self.maxDiff = None
         token = None
+        target_stitch.CONFIG ={
+            'token': "some-token",
+            'client_id': "some-client",
+            'disable_collection': True,
+            'connection_ns': "some-ns",
+            'batch_size_preferences' : {
+                'full_table_streams' : [],
+                'batch_size_preference': None,
+                'user_batch_size_preference': None,
+            },
+            'turbo_boost_factor' : 10,
+            'small_batch_url' : "http://small-batch",
+            'big_batch_url' : "http://big-batch",
+        }
+
         handler = StitchHandler(target_stitch.DEFAULT_MAX_BATCH_BYTES, 3)
 
         self.og_check_send_exception = target_stitch.check_send_exception
@@ -682,21 +763,6 @@ class BufferingPerStreamConstraints(unittest.TestCase):
                     target_stitch.SEND_EXCEPTION,
                     target_stitch.PENDING_REQUESTS)
 
-        target_stitch.CONFIG ={
-            'token': "some-token",
-            'client_id': "some-client",
-            'disable_collection': True,
-            'connection_ns': "some-ns",
-            'batch_size_preferences' : {
-                'full_table_streams' : [],
-                'batch_size_preference': None,
-                'user_batch_size_preference': None,
-            },
-            'turbo_boost_factor' : 10,
-            'small_batch_url' : "http://small-batch",
-            'big_batch_url' : "http://big-batch",
-        }
-
     def test_flush_based_on_message_count(self):
         # Tests that the target will buffer records per stream. This will
         # allow the tap to alternate which streams it is emitting records
@@ -888,6 +954,21 @@ class BufferingPerStreamNoStateOnFailure(unittest.TestCase):
         time.sleep(20)
         self.maxDiff = None
         token = None
+        target_stitch.CONFIG ={
+            'token': "some-token",
+            'client_id': "some-client",
+            'disable_collection': True,
+            'connection_ns': "some-ns",
+            'batch_size_preferences' : {
+                'full_table_streams' : [],
+                'batch_size_preference': None,
+                'user_batch_size_preference': None,
+            },
+            'turbo_boost_factor' : 10,
+            'small_batch_url' : "http://small-batch",
+            'big_batch_url' : "http://big-batch",
+        }
+
         handler = StitchHandler(target_stitch.DEFAULT_MAX_BATCH_BYTES, 3)
 
         # Swap out the post_coroutine with a mocked one to fake failures
@@ -925,21 +1006,6 @@ class BufferingPerStreamNoStateOnFailure(unittest.TestCase):
                     target_stitch.SEND_EXCEPTION,
                     target_stitch.PENDING_REQUESTS)
 
-        target_stitch.CONFIG ={
-            'token': "some-token",
-            'client_id': "some-client",
-            'disable_collection': True,
-            'connection_ns': "some-ns",
-            'batch_size_preferences' : {
-                'full_table_streams' : [],
-                'batch_size_preference': None,
-                'user_batch_size_preference': None,
-            },
-            'turbo_boost_factor' : 10,
-            'small_batch_url' : "http://small-batch",
-            'big_batch_url' : "http://big-batch",
-        }
-
 
     def tearDown(self):
         target_stitch.post_coroutine = self.actual_post_coroutine
@@ -10,11 +10,13 @@ import jsonschema
 import simplejson
 import decimal
 import re
+import tempfile
 import time
 
 from decimal import Decimal
 from jsonschema import ValidationError, Draft4Validator, validators, FormatChecker
 from singer import ActivateVersionMessage, RecordMessage, utils, parse_message
+from aiohttp.client_exceptions import ClientOSError, ServerDisconnectedError
 
 
 class DummyClient(object):
@@ -49,9 +51,19 @@ schema = {"type": "SCHEMA",
           "schema": {"properties": {"i": {"type": "integer"}}}
 }
 
+# Serialized once here so the tests below don't re-encode their inputs
+SCHEMA_LINE = json.dumps(schema)
+RECORD_LINES = [json.dumps(record(i)) for i in range(11)]
+STATE_LINES = [json.dumps(state(i)) for i in range(11)]
+
 def load_sample_lines(filename):
+    # Split on '\n' only, as iterating the file does. str.splitlines would
+    # also break on characters like '\u2028' that are legal in JSON strings.
     with open('tests/' + filename) as fp:
-        return [line for line in fp]
+        lines = fp.read().split('\n')
+    if lines[-1]:
+        return [line + '\n' for line in lines[:-1]] + [lines[-1]]
+    return [line + '\n' for line in lines[:-1]]
 
 
 class TestTargetStitch(unittest.TestCase):
@@ -112,21 +124,21 @@ class TestTargetStitch(unittest.TestCase):
     def test_persist_last_state_when_stream_ends_with_record(self):
         self.target_stitch.max_batch_records = 3
         inputs = [
-            schema,
-            record(0), state(0), record(1), state(1), record(2),
+            SCHEMA_LINE,
+            RECORD_LINES[0], STATE_LINES[0], RECORD_LINES[1], STATE_LINES[1], RECORD_LINES[2],
             # flush state 1
-            state(2), record(3), state(3), record(4), state(4), record(5),
+            STATE_LINES[2], RECORD_LINES[3], STATE_LINES[3], RECORD_LINES[4], STATE_LINES[4], RECORD_LINES[5],
             # flush state 4
-            record(6),
-            record(7),
-            record(8),
+            RECORD_LINES[6],
+            RECORD_LINES[7],
+            RECORD_LINES[8],
             # flush empty states
-            state(8),
-            record(9),
-            state(9),
-            record(10)]
+            STATE_LINES[8],
+            RECORD_LINES[9],
+            STATE_LINES[9],
+            RECORD_LINES[10]]
 
-        self.target_stitch.consume(message_queue(inputs))
+        self.target_stitch.consume(inputs)
 
         expected = [[0, 1, 2], [3, 4, 5], [6, 7, 8], [9, 10]]
         got = [[r.record['i'] for r in batch['messages']] for batch in self.client.batches]
@@ -135,22 +147,22 @@ class TestTargetStitch(unittest.TestCase):
     def test_persist_last_state_when_stream_ends_with_state(self):
         self.target_stitch.max_batch_records = 3
         inputs = [
-            schema,
-            record(0), state(0), record(1), state(1), record(2),
+            SCHEMA_LINE,
+            RECORD_LINES[0], STATE_LINES[0], RECORD_LINES[1], STATE_LINES[1], RECORD_LINES[2],
             # flush state 1
-            state(2), record(3), state(3), record(4), state(4), record(5),
+            STATE_LINES[2], RECORD_LINES[3], STATE_LINES[3], RECORD_LINES[4], STATE_LINES[4], RECORD_LINES[5],
             # flush state 4
-            record(6),
-            record(7),
-            record(8),
+            RECORD_LINES[6],
+            RECORD_LINES[7],
+            RECORD_LINES[8],
             # flush empty states
-            state(8),
-            record(9),
-            state(9),
-            record(10),
-            state(10)]
+            STATE_LINES[8],
+            RECORD_LINES[9],
+            STATE_LINES[9],
+            RECORD_LINES[10],
+            STATE_LINES[10]]
 
-        self.target_stitch.consume(message_queue(inputs))
+        self.target_stitch.consume(inputs)
 
 
         expected = [[0, 1, 2], [3, 4, 5], [6, 7, 8], [9, 10]]
@@ -161,11 +173,11 @@ class TestTargetStitch(unittest.TestCase):
         self.target_stitch.batch_delay_seconds = -1
         self.target_stitch.max_batch_records = 10000
         inputs = [
-            schema,
-            record(0),
-            record(1),
-            record(2)]
-        self.target_stitch.consume(message_queue(inputs))
+            SCHEMA_LINE,
+            RECORD_LINES[0],
+            RECORD_LINES[1],
+            RECORD_LINES[2]]
+        self.target_stitch.consume(inputs)
         expected = [[0], [1], [2]]
         got = [[r.record['i'] for r in batch['messages']] for batch in self.client.batches]
         self.assertEqual(got, expected)
@@ -248,7 +260,7 @@ class TestSerialize(unittest.TestCase):
         self.assertEqual(1, len(self.serialize_with_limit(2000)))
         self.assertEqual(2, len(self.serialize_with_limit(1000)))
         self.assertEqual(4, len(self.serialize_with_limit(500)))
-        self.assertEqual(8, len(self.serialize_with_limit(385)))
+        self.assertEqual(8, len(self.serialize_with_limit(350)))
 
     def test_raises_if_cant_stay_in_limit(self):
         data = 'a' * 21000000
@@ -270,7 +282,7 @@ class TestSerialize(unittest.TestCase):
         self.assertEqual(expected, self.unpack_colors(self.serialize_with_limit(2000)))
         self.assertEqual(expected, self.unpack_colors(self.serialize_with_limit(1000)))
         self.assertEqual(expected, self.unpack_colors(self.serialize_with_limit(500)))
-        self.assertEqual(expected, self.unpack_colors(self.serialize_with_limit(385)))
+        self.assertEqual(expected, self.unpack_colors(self.serialize_with_limit(350)))
 
     def test_serialize_time_extracted(self):
         """ Test that we're not corrupting timestamps with cross platform parsing. (Test case for OSX, specifically) """
@@ -284,6 +296,13 @@ class TestSerialize(unittest.TestCase):
 
         self.assertEqual(expected, actual)
 
+    def test_serialize_keeps_non_finite_numbers(self):
+        line = '{"type": "RECORD", "stream": "test", "record": {"a": NaN, "b": Infinity, "c": -Infinity}}'
+        message = target_stitch.overloaded_parse_message(line)
+        batch = target_stitch.serialize([message], {}, [], [], 1000, target_stitch.DEFAULT_MAX_BATCH_RECORDS)[0]
+
+        self.assertIn(b'"data":{"a":NaN,"b":Infinity,"c":-Infinity}', batch)
+
 
     def create_raw_record(self, value):
         return '{"value": ' + value + '}'
@@ -291,6 +310,94 @@ class TestSerialize(unittest.TestCase):
     def create_raw_record_message(self,raw_record):
         return '{"type": "RECORD", "stream": "test", "record": ' + raw_record + '}'
 
+class TestValidatingHandler(unittest.TestCase):
+
+    def setUp(self):
+        self.handler = target_stitch.ValidatingHandler()
+        self.schema = {'type': 'object',
+                       'properties': {'id': {'type': 'integer'}}}
+
+    def test_reuses_validator_for_same_schema(self):
+        validator = self.handler.get_validator('users', self.schema)
+        self.assertIs(validator, self.handler.get_validator('users', self.schema))
+        equal_schema = dict(self.schema)
+        self.assertIs(validator, self.handler.get_validator('users', equal_schema))
+        self.assertIs(self.handler.validators['users'][0], equal_schema)
+
+    def test_replaces_validator_when_schema_changes(self):
+        validator = self.handler.get_validator('users', self.schema)
+        self.assertIsNot(validator, self.handler.get_validator('users', {'type': 'object'}))
+        self.assertIsNot(validator, self.handler.get_validator('users', self.schema))
+        self.assertEqual(len(self.handler.validators), 1)
+
+    def test_raises_on_invalid_record(self):
+        messages = [RecordMessage(stream='users', record={'id': 1}),
+                    RecordMessage(stream='users', record={'id': 'not an int'})]
+        with self.assertRaises(target_stitch.TargetStitchException):
+            self.handler.handle_batch(messages, False, self.schema, ['id'])
+
+class TestLoggingHandler(unittest.TestCase):
+
+    def test_writes_one_request_body_per_line(self):
+        schema = {'type': 'object', 'properties': {'id': {'type': 'integer'}}}
+        messages = [RecordMessage(stream='users', record={'id': i}) for i in range(6)]
+        with tempfile.NamedTemporaryFile() as output_file:
+            handler = target_stitch.LoggingHandler(output_file, 200, target_stitch.DEFAULT_MAX_BATCH_RECORDS)
+            handler.handle_batch(messages, False, schema, ['id'])
+            output_file.seek(0)
+            bodies = [json.loads(line) for line in output_file]
+
+        expected = target_stitch.serialize(messages, schema, ['id'], None, 200, target_stitch.DEFAULT_MAX_BATCH_RECORDS)
+        self.assertEqual(len(bodies), len(expected))
+        self.assertEqual([[m['data']['id'] for m in body['messages']] for body in bodies],
+                         [[m['data']['id'] for m in json.loads(body)['messages']] for body in expected])
+        self.assertEqual(bodies[0]['table_name'], 'users')
+
+    @unittest.skipIf(not target_stitch.HAS_MSGPACK, 'msgpack is not installed')
+    def test_msgpack_bodies_round_trip(self):
+        schema = {'type': 'object', 'properties': {'amount': {'type': 'number'}}}
+        messages = [RecordMessage(stream='payments', record={'amount': Decimal('-9999999999999999.9999999999999999999999')}),
+                    RecordMessage(stream='payments', record={'amount': Decimal('1.10')}),
+                    RecordMessage(stream='payments', record={'amount': 2 ** 70}),
+                    ActivateVersionMessage(stream='payments', version=1)]
+        with tempfile.NamedTemporaryFile() as output_file:
+            handler = target_stitch.LoggingHandler(output_file, 4000000, target_stitch.DEFAULT_MAX_BATCH_RECORDS, 'msgpack')
+            handler.handle_batch(messages, True, schema, [])
+            output_file.seek(0)
+            bodies = list(target_stitch.read_packed_bodies(output_file))
+
+        self.assertEqual(len(bodies), 1)
+        self.assertEqual(bodies[0]['table_name'], 'payments')
+        self.assertEqual(bodies[0]['schema'], schema)
+        self.assertEqual([m['action'] for m in bodies[0]['messages']], ['upsert', 'upsert', 'upsert', 'activate_version'])
+        self.assertEqual([m['data']['amount'] for m in bodies[0]['messages'][:3]],
+                         [Decimal('-9999999999999999.9999999999999999999999'), Decimal('1.10'), 2 ** 70])
+
+class TestCheckSendException(unittest.TestCase):
+
+    def tearDown(self):
+        target_stitch.SEND_EXCEPTION = None
+
+    def test_uses_message_from_response_body(self):
+        target_stitch.SEND_EXCEPTION = target_stitch.StitchClientResponseError(400, {'message': 'Record is missing key property'})
+        with self.assertRaisesRegex(target_stitch.TargetStitchException, 'Error persisting data to Stitch: 400: Record is missing key property$'):
+            target_stitch.check_send_exception()
+
+    def test_uses_whole_response_body_without_message(self):
+        target_stitch.SEND_EXCEPTION = target_stitch.StitchClientResponseError(200, 'unable to parse response body as json')
+        with self.assertRaisesRegex(target_stitch.TargetStitchException, 'Error persisting data to Stitch: 200: unable to parse response body as json$'):
+            target_stitch.check_send_exception()
+
+    def test_reports_server_disconnect(self):
+        target_stitch.SEND_EXCEPTION = ServerDisconnectedError()
+        with self.assertRaisesRegex(target_stitch.TargetStitchException, 'Stitch closed the connection'):
+            target_stitch.check_send_exception()
+
+    def test_reports_connection_reset(self):
+        target_stitch.SEND_EXCEPTION = ClientOSError(104, 'Connection reset by peer')
+        with self.assertRaisesRegex(target_stitch.TargetStitchException, 'Connection to Stitch was reset'):
+            target_stitch.check_send_exception()
+
 class TestDetermineStitchUrl(unittest.TestCase):
     def test_full_table_stream(self):
         big_batch_url = 'https://bigbatches.org'
@@ -388,6 +495,20 @@ class TestSequenceNumbers(unittest.TestCase):
         self.assertEqual(len(generated_seqs), len(set(generated_seqs)))
 
 
+    def test_generate_sequence_shared_clock(self):
+        # Serializing a batch samples the clock once for every message
+        # - Sequences must still be unique and increasing past the modulo wrap
+        now = time.time()
+        generated_seqs = [target_stitch.generate_sequence(i,target_stitch.DEFAULT_MAX_BATCH_RECORDS,now)
+                          for i in range(target_stitch.DEFAULT_MAX_BATCH_RECORDS * 10)]
+
+        # Assert number's width for downstream
+        [self.assertEqual(len(str(s)), self.STANDARD_SEQ_LENGTH) for s in generated_seqs]
+        # Assert they are all at least increasing
+        self.assertEqual(generated_seqs, sorted(generated_seqs))
+        # Assert no collisions
+        self.assertEqual(len(generated_seqs), len(set(generated_seqs)))
+
     def test_generate_sequence_mixed_case(self):
         # Call with varying lengths of batches to ensure the widths mix
         regular_batch = [(i,target_stitch.DEFAULT_MAX_BATCH_RECORDS) for i in range(100)]